@@ -1,11 +1,19 @@
 # ga4_backdate_chunked.py
+import io
+import json
 import os
+import asyncio
+import aiohttp
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
+from google.api_core.exceptions import NotFound
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 from google.cloud import bigquery
 from google.oauth2 import service_account
 
@@ -18,9 +26,40 @@ DATASET = "argus"
 STAGE_TABLE = f"{DATASET}.ga4_sessions_stage"
 TARGET_TABLE = f"{DATASET}.ga4_sessions_by_channel"
 
+# Constant per property; stored dictionary-encoded like the channel column
+PROPERTY_COLS = ["property_id", "property_name", "account_id", "account_name", "user", "token_file"]
+DICT_STRING = pa.dictionary(pa.int32(), pa.string())
+
+# Explicit upload schema; BigQuery reads the types straight from the Parquet file
+STAGE_SCHEMA = pa.schema([
+    ("property_id", DICT_STRING),
+    ("property_name", DICT_STRING),
+    ("account_id", DICT_STRING),
+    ("account_name", DICT_STRING),
+    ("user", DICT_STRING),
+    ("token_file", DICT_STRING),
+    ("date", pa.date32()),
+    ("sessionDefaultChannelGroup", DICT_STRING),
+    ("sessions", pa.int64()),
+])
+
+# Target layout; ensure_target_layout rebuilds an existing target that lacks it
+TARGET_PARTITION_FIELD = "date"
+TARGET_CLUSTER_FIELDS = ["property_id", "sessionDefaultChannelGroup"]
+TARGET_LAYOUT_SQL = f"""PARTITION BY {TARGET_PARTITION_FIELD}
+CLUSTER BY {", ".join(TARGET_CLUSTER_FIELDS)}"""
+
 # Properties known to exceed RPC limits
 HEAVY_IDS = {"410236109"}  # ids of sites to backdate
 
+# Concurrent runReport calls; keep under the GA4 per-IP quota
+RUN_REPORT_URL = "https://analyticsdata.googleapis.com/v1beta/properties/{}:runReport"
+MAX_CONCURRENT_REQUESTS = 10
+MAX_CONNECTIONS = 20
+
+# ErrorInfo reasons GA4 attaches to a 400 when a report is too large
+TOO_LARGE_REASONS = {"responseTooLarge", "RESPONSE_TOO_LARGE"}
+
 # ===== DATES: last 50 months from yesterday (inclusive) =====
 end_date = datetime.today().date() - timedelta(days=1)
 start_date = (end_date - relativedelta(months=50)) + timedelta(days=1)
@@ -28,6 +67,63 @@ start_str = start_date.strftime("%Y-%m-%d")
 end_str = end_date.strftime("%Y-%m-%d")
 
 # ===== HELPERS =====
+def constant_column(value, n):
+    # n rows of one value: a single-entry dictionary plus zeroed indices.
+    # A blank CSV cell becomes null indices over an empty dictionary, since
+    # Parquet cannot write a null stored inside the dictionary itself.
+    if pd.isna(value):
+        return pa.DictionaryArray.from_arrays(pa.nulls(n, pa.int32()), pa.array([], pa.string()))
+    return pa.DictionaryArray.from_arrays(
+        pa.array(np.zeros(n, dtype=np.int32)), pa.array([str(value)], pa.string())
+    )
+
+def report_columns(resp_rows):
+    # YYYYMMDD strings are parsed in Arrow's C kernel, not per row in Python
+    raw_dates = pa.array([rr["dimensionValues"][0]["value"] for rr in resp_rows], pa.string())
+    return {
+        "date": pc.cast(pc.strptime(raw_dates, format="%Y%m%d", unit="s"), pa.date32()),
+        "sessionDefaultChannelGroup": pa.array(
+            [rr["dimensionValues"][1]["value"] or "(unassigned)" for rr in resp_rows], pa.string()
+        ).dictionary_encode(),
+        "sessions": pa.array([int(rr["metricValues"][0]["value"]) for rr in resp_rows], pa.int64()),
+    }
+
+def rebuild_target(bq):
+    # BigQuery refuses CREATE OR REPLACE with a different partitioning spec, so
+    # copy into a side table with the target layout and swap it in. The script
+    # stops at the first failing statement; if the swap fails the data is left
+    # in the side table rather than lost.
+    target = f"{PROJECT_ID}.{TARGET_TABLE}"
+    rebuilt = f"{target}_rebuild"
+    bq.query(f"""
+DROP TABLE IF EXISTS `{rebuilt}`;
+CREATE TABLE `{rebuilt}`
+{TARGET_LAYOUT_SQL}
+AS SELECT * FROM `{target}`;
+DROP TABLE `{target}`;
+ALTER TABLE `{rebuilt}` RENAME TO `{TARGET_TABLE.split(".")[-1]}`;
+""").result()
+
+def ensure_target_layout(bq):
+    # CREATE TABLE IF NOT EXISTS leaves an existing target as it is, so a target
+    # created before partitioning/clustering was introduced is rebuilt once
+    target = f"{PROJECT_ID}.{TARGET_TABLE}"
+    try:
+        existing = bq.get_table(target)
+    except NotFound:
+        return
+    partitioning = existing.time_partitioning
+    partitioned = (
+        partitioning is not None
+        and partitioning.type_ == bigquery.TimePartitioningType.DAY
+        and partitioning.field == TARGET_PARTITION_FIELD
+    )
+    if partitioned and existing.clustering_fields == TARGET_CLUSTER_FIELDS:
+        return
+    print(f"Rebuilding {TARGET_TABLE}: partition by {TARGET_PARTITION_FIELD}, "
+          f"cluster by {', '.join(TARGET_CLUSTER_FIELDS)}")
+    rebuild_target(bq)
+
 def iter_chunks(start_d, end_d, span_days):
     cur = start_d
     step = timedelta(days=span_days - 1)  # inclusive span
@@ -36,121 +132,221 @@ def iter_chunks(start_d, end_d, span_days):
         yield cur, chunk_end
         cur = chunk_end + timedelta(days=1)
 
-def fetch_chunked(analytics_data, property_id, start_d, end_d, base_span=210):
-    span = base_span  # start ~7 months
-    while True:
-        try:
-            for s, e in iter_chunks(start_d, end_d, span):
-                body = {
-                    "dateRanges": [{"startDate": s.strftime("%Y-%m-%d"),
-                                    "endDate":   e.strftime("%Y-%m-%d")}],
-                    "dimensions": [
-                        {"name": "date"},
-                        {"name": "sessionDefaultChannelGroup"}
-                    ],
-                    "metrics": [{"name": "sessions"}],
-                    "keepEmptyRows": False
-                }
-                resp = analytics_data.properties().runReport(
-                    property=f"properties/{property_id}",
-                    body=body
-                ).execute()
-                yield resp
-            break
-        except HttpError as ex:
-            msg = str(ex)
-            if "exceeds limit" in msg or "too_large" in msg:
-                if span <= 31:
-                    raise
-                span = max(31, span // 2)
-                print(f"Property {property_id}: response too large, retry with {span}-day chunks")
-            else:
+async def post_report(session, sem, token, property_id, s, e):
+    body = {
+        "dateRanges": [{"startDate": s.strftime("%Y-%m-%d"),
+                        "endDate":   e.strftime("%Y-%m-%d")}],
+        "dimensions": [
+            {"name": "date"},
+            {"name": "sessionDefaultChannelGroup"}
+        ],
+        "metrics": [{"name": "sessions"}],
+        "keepEmptyRows": False
+    }
+    async with sem:
+        async with session.post(
+            RUN_REPORT_URL.format(property_id),
+            json=body,
+            headers={"Authorization": f"Bearer {token}"}
+        ) as resp:
+            if resp.status >= 400:
+                # keep the JSON error body for is_response_too_large
+                raise aiohttp.ClientResponseError(
+                    resp.request_info, resp.history,
+                    status=resp.status, message=await resp.text()
+                )
+            return await resp.json()
+
+def is_response_too_large(ex):
+    if ex.status != 400:
+        return False
+    try:
+        err = json.loads(ex.message)["error"]
+    except (ValueError, KeyError, TypeError):
+        return False
+    if any(d.get("reason") in TOO_LARGE_REASONS for d in err.get("details", [])):
+        return True
+    # fall back to the message text when no ErrorInfo reason is attached
+    msg = err.get("message", "")
+    return "exceeds limit" in msg or "too_large" in msg
+
+async def fetch_span(session, sem, token, property_id, s, e, span):
+    try:
+        return [await post_report(session, sem, token, property_id, s, e)]
+    except aiohttp.ClientResponseError as ex:
+        if is_response_too_large(ex):
+            if span <= 31:
                 raise
+            span = max(31, span // 2)
+            print(f"Property {property_id}: response too large, retry {s}..{e} with {span}-day chunks")
+            async with asyncio.TaskGroup() as tg:
+                tasks = [
+                    tg.create_task(fetch_span(session, sem, token, property_id, cs, ce, span))
+                    for cs, ce in iter_chunks(s, e, span)
+                ]
+            return [resp for task in tasks for resp in task.result()]
+        raise
 
-# ===== LOAD PROPERTIES =====
-refined = pd.read_csv(INPUT_CSV, dtype={"property_id": str, "account_id": str})
-refined = refined[refined["property_id"].astype(str).isin(HEAVY_IDS)]
-if refined.empty:
-    raise SystemExit("No heavy profiles found in refined_properties.csv")
+async def fetch_chunked_async(session, sem, token, property_id, start_d, end_d, base_span=210):
+    # TaskGroup cancels the remaining spans of a property as soon as one fails
+    spans = list(iter_chunks(start_d, end_d, base_span))
+    async with asyncio.TaskGroup() as tg:
+        tasks = [
+            tg.create_task(fetch_span(session, sem, token, property_id, s, e, base_span))
+            for s, e in spans
+        ]
+    return [resp for task in tasks for resp in task.result()]
 
-# ===== FETCH =====
-rows = []
-for _, r in refined.iterrows():
+def first_error(ex):
+    # TaskGroup failures arrive wrapped (and nested, for split spans)
+    while isinstance(ex, BaseExceptionGroup):
+        ex = ex.exceptions[0]
+    return ex
+
+async def fetch_property(session, sem, token, r):
     property_id = str(r["property_id"])
-    token_file = r["token_file"]
+    print(f"Fetching (chunked): {r['property_name']} ({property_id}) [{start_str}..{end_str}]")
+    try:
+        responses = await fetch_chunked_async(
+            session, sem, token, property_id, start_date, end_date, base_span=210
+        )
+        return r, responses
+    except Exception as e:
+        print(f"Error {property_id}: {first_error(e)}")
+        return r, []
 
-    if not token_file or not os.path.exists(token_file):
-        print(f"Token missing for {r.get('user','?')} -> {token_file}. Skip {property_id}")
-        continue
+async def fetch_user(session, sem, token_file, user_props):
+    rows = [r for _, r in user_props.iterrows()]
+
+    if pd.isna(token_file) or not token_file or not os.path.exists(token_file):
+        for r in rows:
+            print(f"Token missing for {r.get('user','?')} -> {token_file}. Skip {r['property_id']}")
+        return [(r, []) for r in rows]
 
-    print(f"Fetching (chunked): {r['property_name']} ({property_id}) [{start_str}..{end_str}]")
     try:
+        # refresh once per user, then reuse the bearer for all of their properties
         creds = Credentials.from_authorized_user_file(token_file, SCOPES)
-        analytics_data = build('analyticsdata', 'v1beta', credentials=creds, cache_discovery=False)
-
-        for resp in fetch_chunked(analytics_data, property_id, start_date, end_date, base_span=210):
-            for rr in resp.get("rows", []):
-                raw_date = rr["dimensionValues"][0]["value"]  # YYYYMMDD
-                ch = rr["dimensionValues"][1]["value"] or "(unassigned)"
-                date_dt = datetime.strptime(raw_date, "%Y%m%d").date()
-                sessions_val = int(rr["metricValues"][0]["value"])
-
-                rows.append({
-                    "property_id": property_id,
-                    "property_name": r["property_name"],
-                    "account_id": r["account_id"],
-                    "account_name": r["account_name"],
-                    "user": r["user"],
-                    "token_file": token_file,
-                    "date": date_dt,
-                    "sessionDefaultChannelGroup": ch,
-                    "sessions": sessions_val
-                })
-
+        await asyncio.to_thread(creds.refresh, Request())
     except Exception as e:
-        print(f"Error {property_id}: {e}")
-
-# ===== DATAFRAME =====
-df = pd.DataFrame(rows)
-if df.empty:
-    print("No data fetched. Exit.")
-    raise SystemExit(0)
-
-df.sort_values(["property_id", "date", "sessionDefaultChannelGroup"], inplace=True)
-
-# ===== UPLOAD TO BIGQUERY: stage then MERGE =====
-bq_creds = service_account.Credentials.from_service_account_file(
-    SA_KEY_PATH,
-    scopes=["https://www.googleapis.com/auth/bigquery"]
-)
-bq = bigquery.Client(project=PROJECT_ID, credentials=bq_creds)
-
-job_cfg = bigquery.LoadJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
-load_job = bq.load_table_from_dataframe(df, f"{PROJECT_ID}.{STAGE_TABLE}", job_config=job_cfg)
-load_job.result()
-
-merge_sql = f"""
-MERGE `{PROJECT_ID}.{TARGET_TABLE}` T
-USING `{PROJECT_ID}.{STAGE_TABLE}` S
-ON  T.property_id = S.property_id
-AND T.date = S.date
-AND T.sessionDefaultChannelGroup = S.sessionDefaultChannelGroup
-WHEN MATCHED THEN UPDATE SET
-  sessions = S.sessions,
-  property_name = S.property_name,
-  account_id = S.account_id,
-  account_name = S.account_name,
-  user = S.user,
-  token_file = S.token_file,
-  _ingested_at = CURRENT_TIMESTAMP()
-WHEN NOT MATCHED THEN INSERT
-  (property_id, property_name, account_id, account_name, user, token_file,
-   date, sessionDefaultChannelGroup, sessions, _ingested_at)
-VALUES
-  (S.property_id, S.property_name, S.account_id, S.account_name, S.user, S.token_file,
-   S.date, S.sessionDefaultChannelGroup, S.sessions, CURRENT_TIMESTAMP());
-"""
-bq.query(merge_sql).result()
-
-print(f"Backfill window: {start_str} .. {end_str}")
-print(f"Stage rows: {len(df)} merged into {TARGET_TABLE}")
+        for r in rows:
+            print(f"Error {r['property_id']}: {e}")
+        return [(r, []) for r in rows]
+
+    return await asyncio.gather(*[
+        fetch_property(session, sem, creds.token, r) for r in rows
+    ])
+
+async def fetch_all(refined):
+    # one session (and connection pool) shared by every user and property
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        per_user = await asyncio.gather(*[
+            fetch_user(session, sem, token_file, user_props)
+            for token_file, user_props in refined.groupby("token_file", dropna=False, sort=False)
+        ])
+    return [result for user_results in per_user for result in user_results]
+
+def main():
+    # ===== LOAD PROPERTIES =====
+    refined = pd.read_csv(INPUT_CSV, dtype={"property_id": str, "account_id": str})
+    refined = refined[refined["property_id"].astype(str).isin(HEAVY_IDS)]
+    if refined.empty:
+        raise SystemExit("No heavy profiles found in refined_properties.csv")
+
+    # ===== FETCH =====
+    # each response is converted to typed Arrow arrays as soon as it is read
+    chunks = {name: [] for name in STAGE_SCHEMA.names}
+    for r, responses in asyncio.run(fetch_all(refined)):
+        for resp in responses:
+            resp_rows = resp.get("rows", [])
+            if not resp_rows:
+                continue
+            for c, arr in report_columns(resp_rows).items():
+                chunks[c].append(arr)
+            for c in PROPERTY_COLS:
+                chunks[c].append(constant_column(r[c], len(resp_rows)))
+
+    # ===== ARROW TABLE =====
+    if not chunks["date"]:
+        print("No data fetched. Exit.")
+        raise SystemExit(0)
+
+    # No sort: rows already arrive grouped by property, the MERGE matches on keys
+    # rather than order, and BigQuery lays out storage by partition/cluster anyway.
+    table = pa.Table.from_arrays(
+        [pa.chunked_array(chunks[f.name], f.type) for f in STAGE_SCHEMA],
+        schema=STAGE_SCHEMA
+    )
+
+    # ===== UPLOAD TO BIGQUERY: stage then MERGE =====
+    bq_creds = service_account.Credentials.from_service_account_file(
+        SA_KEY_PATH,
+        scopes=["https://www.googleapis.com/auth/bigquery"]
+    )
+    bq = bigquery.Client(project=PROJECT_ID, credentials=bq_creds)
+
+    buf = io.BytesIO()
+    pq.write_table(table, buf, compression="snappy")
+    buf.seek(0)
+
+    job_cfg = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE
+    )
+    load_job = bq.load_table_from_file(buf, f"{PROJECT_ID}.{STAGE_TABLE}", job_config=job_cfg)
+    load_job.result()
+
+    ensure_target_layout(bq)
+
+    # ensure_target_layout has made the target date-partitioned and clustered, so
+    # the window predicate in the MERGE ON clause prunes to the backfilled
+    # partitions and clustering narrows the join within them. The DDL only
+    # creates a missing target; DDL and MERGE run as one script job.
+    merge_sql = f"""
+    CREATE TABLE IF NOT EXISTS `{PROJECT_ID}.{TARGET_TABLE}` (
+      property_id STRING,
+      property_name STRING,
+      account_id STRING,
+      account_name STRING,
+      user STRING,
+      token_file STRING,
+      date DATE,
+      sessionDefaultChannelGroup STRING,
+      sessions INT64,
+      _ingested_at TIMESTAMP
+    )
+    {TARGET_LAYOUT_SQL};
+
+    MERGE `{PROJECT_ID}.{TARGET_TABLE}` T
+    USING `{PROJECT_ID}.{STAGE_TABLE}` S
+    ON  T.property_id = S.property_id
+    AND T.date = S.date
+    AND T.sessionDefaultChannelGroup = S.sessionDefaultChannelGroup
+    AND T.date BETWEEN @start AND @end
+    WHEN MATCHED THEN UPDATE SET
+      sessions = S.sessions,
+      property_name = S.property_name,
+      account_id = S.account_id,
+      account_name = S.account_name,
+      user = S.user,
+      token_file = S.token_file,
+      _ingested_at = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN INSERT
+      (property_id, property_name, account_id, account_name, user, token_file,
+       date, sessionDefaultChannelGroup, sessions, _ingested_at)
+    VALUES
+      (S.property_id, S.property_name, S.account_id, S.account_name, S.user, S.token_file,
+       S.date, S.sessionDefaultChannelGroup, S.sessions, CURRENT_TIMESTAMP());
+    """
+    merge_cfg = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("start", "DATE", start_date),
+        bigquery.ScalarQueryParameter("end", "DATE", end_date),
+    ])
+    bq.query(merge_sql, job_config=merge_cfg).result()
+
+    print(f"Backfill window: {start_str} .. {end_str}")
+    print(f"Stage rows: {table.num_rows} merged into {TARGET_TABLE}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import io
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+ga4 = pytest.importorskip("ga4_backdate_chunked")
+
+
+def test_blank_property_cell_writes_to_parquet():
+    resp_rows = [
+        {"dimensionValues": [{"value": "20240101"}, {"value": "Organic Search"}],
+         "metricValues": [{"value": "12"}]},
+        {"dimensionValues": [{"value": "20240102"}, {"value": ""}],
+         "metricValues": [{"value": "3"}]},
+    ]
+    prop = {"property_id": "410236109", "property_name": "Site", "account_id": "1",
+            "account_name": float("nan"), "user": "someone", "token_file": "token.json"}
+
+    columns = ga4.report_columns(resp_rows)
+    for c in ga4.PROPERTY_COLS:
+        columns[c] = ga4.constant_column(prop[c], len(resp_rows))
+    table = pa.Table.from_arrays(
+        [pa.chunked_array([columns[f.name]], f.type) for f in ga4.STAGE_SCHEMA],
+        schema=ga4.STAGE_SCHEMA
+    )
+
+    buf = io.BytesIO()
+    pq.write_table(table, buf, compression="snappy")
+    buf.seek(0)
+    back = pq.read_table(buf)
+
+    assert back.column("account_name").to_pylist() == [None, None]
+    assert back.column("property_name").to_pylist() == ["Site", "Site"]
+    assert back.column("sessionDefaultChannelGroup").to_pylist() == ["Organic Search", "(unassigned)"]
+
+
+class _Job:
+    def result(self):
+        return None
+
+
+class _FakeBigQuery:
+    def __init__(self, table):
+        self.table = table
+        self.queries = []
+
+    def get_table(self, name):
+        return self.table
+
+    def query(self, sql):
+        self.queries.append(sql)
+        return _Job()
+
+
+def _target(partition_field=None, clustering=None):
+    bigquery = pytest.importorskip("google.cloud.bigquery")
+    table = bigquery.Table(f"{ga4.PROJECT_ID}.{ga4.TARGET_TABLE}")
+    if partition_field:
+        table.time_partitioning = bigquery.TimePartitioning(field=partition_field)
+    table.clustering_fields = clustering
+    return table
+
+
+def test_unpartitioned_target_is_swapped_in_from_a_new_table():
+    bq = _FakeBigQuery(_target())
+    ga4.ensure_target_layout(bq)
+
+    assert len(bq.queries) == 1
+    sql = bq.queries[0]
+    assert "CREATE OR REPLACE" not in sql
+    assert f"CREATE TABLE `{ga4.PROJECT_ID}.{ga4.TARGET_TABLE}_rebuild`" in sql
+    assert ga4.TARGET_LAYOUT_SQL in sql
+    assert sql.index("AS SELECT") < sql.index("DROP TABLE `") < sql.index("RENAME TO")
+    assert "RENAME TO `ga4_sessions_by_channel`" in sql
+
+
+def test_target_with_expected_layout_is_left_alone():
+    bq = _FakeBigQuery(_target("date", ga4.TARGET_CLUSTER_FIELDS))
+    ga4.ensure_target_layout(bq)
+
+    assert bq.queries == []
+
+
+def test_partitioned_target_with_other_clustering_uses_the_same_rebuild():
+    bq = _FakeBigQuery(_target("date", ["property_id", "date", "sessionDefaultChannelGroup"]))
+    ga4.ensure_target_layout(bq)
+
+    assert len(bq.queries) == 1
+    assert "CREATE OR REPLACE" not in bq.queries[0]
+    assert "RENAME TO `ga4_sessions_by_channel`" in bq.queries[0]
+
+
+def test_failed_span_cancels_the_rest_of_the_property(monkeypatch):
+    import asyncio
+    from datetime import date
+
+    started, finished = [], []
+
+    async def fake_post_report(session, sem, token, property_id, s, e):
+        started.append(s)
+        if len(started) == 1:
+            raise RuntimeError("403 Forbidden")
+        await asyncio.sleep(5)
+        finished.append(s)
+        return {}
+
+    monkeypatch.setattr(ga4, "post_report", fake_post_report)
+
+    async def run():
+        with pytest.raises(BaseExceptionGroup) as info:
+            await ga4.fetch_chunked_async(
+                None, asyncio.Semaphore(10), "token", "1", date(2024, 1, 1), date(2024, 12, 31), base_span=31
+            )
+        return info.value
+
+    err = asyncio.run(asyncio.wait_for(run(), timeout=2))
+
+    assert str(ga4.first_error(err)) == "403 Forbidden"
+    assert len(started) > 1
+    assert finished == []
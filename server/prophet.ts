@@ -10,6 +10,7 @@ interface SeriesPayload {
   data: SeriesPoint[];
   trend: "flat" | "linear";
   multiplier: number;
+  uncertainty?: boolean;
 }
 
 interface ForecastPoint {
@@ -23,6 +24,7 @@ interface ForecastOutput {
   forecast: ForecastPoint[];
   last_observed: string;
   forecast_end: string;
+  resampled?: string | null;
 }
 
 export interface ProphetForecastInput {
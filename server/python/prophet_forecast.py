@@ -1,28 +1,50 @@
+import hashlib
 import json
+import os
 import sys
 import io
 import logging
 import contextlib
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from typing import Any, Dict, List
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
 
 import pandas as pd
 from dateutil.relativedelta import relativedelta
 from pandas.tseries.offsets import MonthEnd
 
 with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
-    from prophet import Prophet
+    from prophet import Prophet, __version__ as prophet_version
+    from prophet.serialize import model_from_json, model_to_json
 
 
-logging.getLogger("cmdstanpy").setLevel(logging.WARNING)
+# cmdstanpy only installs its own stream handler when the logger has none, so a
+# NullHandler keeps Stan progress chatter off stdout/stderr for every fit.
+cmdstanpy_logger = logging.getLogger("cmdstanpy")
+cmdstanpy_logger.handlers = [logging.NullHandler()]
+cmdstanpy_logger.propagate = False
+cmdstanpy_logger.setLevel(logging.WARNING)
 logging.getLogger("prophet").setLevel(logging.WARNING)
 
+MODEL_CACHE_DIR = Path.home() / ".cache" / "prophet"
+# Bump when fit_model changes in a way the hashed fit settings don't capture.
+MODEL_CACHE_VERSION = 1
+# Inputs change daily, so keep only the most recently used models.
+MODEL_CACHE_MAX_ENTRIES = 32
+UNCERTAINTY_SAMPLES = 1000
+# Inputs longer than MAX_INPUT_POINTS are rejected outright; anything longer than
+# MAX_FIT_POINTS is aggregated to weekly means of daily totals before fitting.
+MAX_INPUT_POINTS = 100_000
+MAX_FIT_POINTS = 2000
+
 
 @dataclass
 class SeriesConfig:
     data: List[Dict[str, Any]]
     trend: str
     multiplier: float
+    uncertainty: bool = True
 
 
 def parse_input(raw: str) -> Dict[str, Any]:
@@ -34,6 +56,10 @@ def parse_input(raw: str) -> Dict[str, Any]:
 
 
 def to_dataframe(series: List[Dict[str, Any]]) -> pd.DataFrame:
+    if len(series) > MAX_INPUT_POINTS:
+        raise ValueError(
+            f"Time series has {len(series)} points; at most {MAX_INPUT_POINTS} are supported"
+        )
     df = pd.DataFrame(series)
     if df.empty:
         raise ValueError("Time series is empty")
@@ -47,6 +73,18 @@ def to_dataframe(series: List[Dict[str, Any]]) -> pd.DataFrame:
     return df
 
 
+def downsample(df: pd.DataFrame) -> Tuple[pd.DataFrame, Optional[str]]:
+    if len(df) <= MAX_FIT_POINTS:
+        return df, None
+
+    # Averaging daily totals keeps the fitted values on the daily scale that the
+    # daily forecast horizon is read on. Each week is stamped with its first day,
+    # so no training point lands after the last real observation.
+    daily = df.set_index("ds")["y"].resample("D").sum(min_count=1)
+    weekly = daily.resample("W", label="left", closed="left").mean().dropna()
+    return weekly.reset_index(), "W"
+
+
 def determine_periods(last_date: pd.Timestamp, months_ahead: int) -> Dict[str, Any]:
     target = last_date + relativedelta(months=months_ahead)
     end_date = (pd.Timestamp(target) + MonthEnd(0)).normalize()
@@ -59,66 +97,122 @@ def determine_periods(last_date: pd.Timestamp, months_ahead: int) -> Dict[str, A
     }
 
 
-def run_forecast(series_config: SeriesConfig, months_ahead: int) -> Dict[str, Any]:
-    df = to_dataframe(series_config.data)
+def model_cache_path(df: pd.DataFrame, trend: str, settings: Dict[str, Any]) -> Path:
+    digest = hashlib.sha256()
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    fit_settings = {
+        "cache_version": MODEL_CACHE_VERSION,
+        "prophet_version": prophet_version,
+        "trend": trend,
+        **settings,
+    }
+    digest.update(json.dumps(fit_settings, sort_keys=True).encode())
+    return MODEL_CACHE_DIR / f"{digest.hexdigest()}.json"
+
+
+def load_cached_model(path: Path) -> Any:
+    try:
+        model = model_from_json(path.read_text())
+    except (OSError, ValueError, KeyError):
+        return None
+    try:
+        os.utime(path)  # mark as recently used for evict_cached_models
+    except OSError:
+        pass
+    return model
+
+
+def store_cached_model(path: Path, model: Any) -> None:
+    # Write to a temp file first so a concurrent reader never sees a partial model.
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(model_to_json(model))
+        os.replace(tmp_path, path)
+    except OSError as exc:
+        logging.getLogger(__name__).debug("Could not cache Prophet model: %s", exc)
+    evict_cached_models()
 
-    captured_stdout = io.StringIO()
-    captured_stderr = io.StringIO()
-    original_stdout = sys.stdout
-    original_stderr = sys.stderr
 
+def evict_cached_models() -> None:
     try:
-        sys.stdout = captured_stdout
-        sys.stderr = captured_stderr
-        model = Prophet(
-            growth=series_config.trend,
-            weekly_seasonality=True,
-            yearly_seasonality=True,
-            daily_seasonality=False,
+        entries = sorted(
+            MODEL_CACHE_DIR.glob("*.json"),
+            key=lambda entry: entry.stat().st_mtime,
+            reverse=True,
         )
-        model.fit(df)
-    finally:
-        sys.stdout = original_stdout
-        sys.stderr = original_stderr
-
-    extra_output = captured_stdout.getvalue().strip()
-    if extra_output:
-        logging.getLogger(__name__).debug(extra_output)
-    extra_error = captured_stderr.getvalue().strip()
-    if extra_error:
-        logging.getLogger(__name__).debug(extra_error)
-
-    last_date = df["ds"].max()
+        for stale in entries[MODEL_CACHE_MAX_ENTRIES:]:
+            stale.unlink(missing_ok=True)
+    except OSError as exc:
+        logging.getLogger(__name__).debug("Could not evict cached Prophet models: %s", exc)
+
+
+def seasonality_settings(df: pd.DataFrame) -> Dict[str, Any]:
+    # Weekly or coarser series carry no day-of-week signal; skip those Fourier terms.
+    # The result is part of the model cache key, so changes here refit cached series.
+    step = df["ds"].diff().median()
+    weekly = not (pd.notna(step) and step >= pd.Timedelta(days=7))
+    return {
+        "weekly_seasonality": weekly,
+        "yearly_seasonality": True,
+        "daily_seasonality": False,
+    }
+
+
+def fit_model(df: pd.DataFrame, trend: str, settings: Dict[str, Any]) -> Any:
+    model = Prophet(growth=trend, **settings)
+    model.fit(df)
+    return model
+
+
+def run_forecast(series_config: SeriesConfig, months_ahead: int) -> bytes:
+    """Return the series result as a pre-serialized JSON object."""
+    df = to_dataframe(series_config.data)
+    last_date = df["ds"].max().normalize()
+    df, resampled = downsample(df)
+
+    settings = seasonality_settings(df)
+    cache_path = model_cache_path(df, series_config.trend, settings)
+    model = load_cached_model(cache_path)
+    if model is None:
+        model = fit_model(df, series_config.trend, settings)
+        store_cached_model(cache_path, model)
+    # Sampling only affects predict, so it is set after the (possibly cached) fit.
+    model.uncertainty_samples = UNCERTAINTY_SAMPLES if series_config.uncertainty else 0
+
     horizon = determine_periods(last_date, months_ahead)
 
-    future = model.make_future_dataframe(
-        periods=horizon["periods"],
-        freq="D",
-        include_history=False,
+    future = pd.DataFrame(
+        {
+            "ds": pd.date_range(
+                last_date + pd.Timedelta(days=1),
+                periods=horizon["periods"],
+                freq="D",
+            )
+        }
     )
-    forecast = model.predict(future)[["ds", "yhat", "yhat_lower", "yhat_upper"]]
+    predicted = model.predict(future)
+    if not series_config.uncertainty:
+        predicted["yhat_lower"] = predicted["yhat"]
+        predicted["yhat_upper"] = predicted["yhat"]
+    forecast = predicted[["ds", "yhat", "yhat_lower", "yhat_upper"]]
 
     factor = 1.0 + max(0.0, float(series_config.multiplier))
-    forecast["yhat"] = forecast["yhat"] * factor
-    forecast["yhat_lower"] = forecast["yhat_lower"] * factor
-    forecast["yhat_upper"] = forecast["yhat_upper"] * factor
-
-    records = []
-    for _, row in forecast.iterrows():
-        records.append(
-            {
-                "date": row["ds"].strftime("%Y-%m-%d"),
-                "yhat": float(row["yhat"]),
-                "yhat_lower": float(row["yhat_lower"]),
-                "yhat_upper": float(row["yhat_upper"]),
-            }
-        )
+    forecast.loc[:, ["yhat", "yhat_lower", "yhat_upper"]] *= factor
 
-    return {
-        "forecast": records,
-        "last_observed": last_date.strftime("%Y-%m-%d"),
-        "forecast_end": horizon["end_date"].strftime("%Y-%m-%d"),
-    }
+    forecast["date"] = forecast["ds"].dt.strftime("%Y-%m-%d")
+    records = forecast[["date", "yhat", "yhat_lower", "yhat_upper"]].to_json(
+        orient="records",
+        double_precision=15,
+    )
+
+    return (
+        '{"forecast":' + records
+        + ',"last_observed":' + json.dumps(last_date.strftime("%Y-%m-%d"))
+        + ',"forecast_end":' + json.dumps(horizon["end_date"].strftime("%Y-%m-%d"))
+        + ',"resampled":' + json.dumps(resampled)
+        + "}"
+    ).encode("utf-8")
 
 
 def main() -> None:
@@ -133,19 +227,29 @@ def main() -> None:
         data=payload["brand"]["data"],
         trend=payload["brand"]["trend"],
         multiplier=float(payload["brand"].get("multiplier", 0.0)),
+        uncertainty=bool(payload["brand"].get("uncertainty", True)),
     )
     non_brand_cfg = SeriesConfig(
         data=payload["nonBrand"]["data"],
         trend=payload["nonBrand"]["trend"],
         multiplier=float(payload["nonBrand"].get("multiplier", 0.0)),
+        uncertainty=bool(payload["nonBrand"].get("uncertainty", True)),
     )
 
-    result = {
-        "brand": run_forecast(brand_cfg, months_ahead),
-        "nonBrand": run_forecast(non_brand_cfg, months_ahead),
-    }
+    # The two fits are independent and CPU-bound in Stan, so run them side by side.
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        brand_future = executor.submit(run_forecast, brand_cfg, months_ahead)
+        non_brand_future = executor.submit(run_forecast, non_brand_cfg, months_ahead)
+        brand_json = brand_future.result()
+        non_brand_json = non_brand_future.result()
 
-    json.dump(result, sys.stdout)
+    out = sys.stdout.buffer
+    out.write(b'{"brand":')
+    out.write(brand_json)
+    out.write(b',"nonBrand":')
+    out.write(non_brand_json)
+    out.write(b"}")
+    out.flush()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,71 @@
+import json
+import math
+
+import pytest
+
+pytest.importorskip("prophet")
+pd = pytest.importorskip("pandas")
+import prophet_forecast as pf
+
+
+def test_downsample_keeps_weeks_within_observed_range():
+    # Hourly series ending mid-week (Wednesday), long enough to be downsampled.
+    ds = pd.date_range("2024-01-01", "2024-04-17 23:00", freq="h")
+    df = pd.DataFrame({"ds": ds, "y": 1.0})
+
+    weekly, resampled = pf.downsample(df)
+
+    assert resampled == "W"
+    assert weekly["ds"].min() <= ds.min()
+    assert weekly["ds"].max() <= ds.max().normalize()
+    assert (weekly["y"] == 24.0).all()
+
+
+def _daily(days, start="2023-01-01"):
+    ds = pd.date_range(start, periods=days, freq="D")
+    return pd.DataFrame({"ds": ds, "y": [100 + 10 * math.sin(i / 7) + 0.1 * i for i in range(days)]})
+
+
+def test_cache_key_is_stable_for_identical_input():
+    df = _daily(60)
+    settings = pf.seasonality_settings(df)
+
+    assert pf.model_cache_path(df, "linear", settings) == pf.model_cache_path(df.copy(), "linear", dict(settings))
+
+
+def test_cache_key_changes_with_trend_and_seasonality():
+    df = _daily(60)
+    settings = pf.seasonality_settings(df)
+    base = pf.model_cache_path(df, "linear", settings)
+
+    assert pf.model_cache_path(df, "flat", settings) != base
+    assert pf.model_cache_path(df, "linear", {**settings, "weekly_seasonality": False}) != base
+
+
+def test_eviction_keeps_most_recent_entries(tmp_path, monkeypatch):
+    import os
+
+    monkeypatch.setattr(pf, "MODEL_CACHE_DIR", tmp_path)
+    total = pf.MODEL_CACHE_MAX_ENTRIES + 3
+    for i in range(total):
+        entry = tmp_path / f"{i:03d}.json"
+        entry.write_text("{}")
+        os.utime(entry, (1_000_000 + i, 1_000_000 + i))
+
+    pf.evict_cached_models()
+
+    kept = sorted(entry.name for entry in tmp_path.glob("*.json"))
+    assert kept == [f"{i:03d}.json" for i in range(3, total)]
+
+
+def test_run_forecast_without_uncertainty_collapses_intervals(tmp_path, monkeypatch):
+    monkeypatch.setattr(pf, "MODEL_CACHE_DIR", tmp_path)
+    df = _daily(400)
+    data = [{"date": d.strftime("%Y-%m-%d"), "value": y} for d, y in zip(df["ds"], df["y"])]
+    config = pf.SeriesConfig(data=data, trend="linear", multiplier=0.0, uncertainty=False)
+
+    result = json.loads(pf.run_forecast(config, 1))
+
+    assert result["forecast"]
+    for point in result["forecast"]:
+        assert point["yhat_lower"] == point["yhat"] == point["yhat_upper"]
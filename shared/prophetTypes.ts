@@ -11,6 +11,7 @@ export interface ProphetForecastSeries {
   forecast: ProphetForecastPoint[];
   last_observed: string;
   forecast_end: string;
+  resampled?: string | null;
 }
 
 export interface ProphetForecastResponse {